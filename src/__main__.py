@@ -1,4 +1,3 @@
-import sys
 import config
 from topp import TOPP
 from training import train_ANET
@@ -6,9 +5,6 @@ from torch import torch
 from neural_network import NeuralNet
 
 
-
-sys.setrecursionlimit(20000)
-
 models = train_ANET(config.MCTS_GAMES, config.MCTS_ROUNDS)
 print("[INFO] Running TOPP...")
 tournament: TOPP = TOPP(models)
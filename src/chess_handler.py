@@ -1,5 +1,6 @@
 from state import StateHandler
 import chess
+import chess.polyglot
 import numpy as np
 import config as config  
 
@@ -80,6 +81,12 @@ class ChessStateHandler(StateHandler):
         self.turn -= 1
 
 
+    def zobrist_hash(self) -> int:
+        """
+        Returns the polyglot zobrist hash of the board, used as key when caching the outputs of the network
+        """
+        return chess.polyglot.zobrist_hash(self.board)
+
     def get_board_state(self) -> np.array:
         """
         Gives the current state of the board, used to visualize board, in the form of a numpy array
@@ -1,3 +1,4 @@
+import os
 import torch
 import numpy as np
 
@@ -12,9 +13,20 @@ TIME_LIMIT = 100  # Time limit for MCTS | AlphaZero used: 0.0040 seconds
 BATCH_SIZE = 32  # Batch size for training | AlphaZero used: 700 000
 NUM_EPOCHS = 10  # Number of epochs to train for
 SIGMA = 0.001 # Sigma for how likely it is to predict the winner from value head
+MCTS_BATCH_SIZE = 16  # Number of leaves evaluated together in one forward pass | Minigo used: 8-64
+VIRTUAL_LOSS = 1  # Loss added to nodes with pending evaluations, spreads a batch over different paths
 
 # ================= Hardwaresettings =================
+NUM_WORKERS = os.cpu_count()  # Number of processes playing games in parallel when generating data
 DEVICE: torch.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+USE_BF16 = DEVICE.type == "cuda" and torch.cuda.is_bf16_supported()  # Run inference in bfloat16 on Ampere and newer
+COMPILE_MODEL = False  # Compile the network with torch.compile, the first forward passes are slow while compiling
+FUSE_BATCH_NORM = True  # Fold the BatchNorm layers into the convolutions of the copy of the network used for inference
+QUANTIZE_MODEL = False  # Run self-play on an int8 copy of the network, only faster when inference runs on the cpu
+USE_INFERENCE_SERVER = DEVICE.type == "cuda"  # Let one process run the network for all self-play workers
+INFERENCE_BATCH_SIZE = 64  # Max number of states the inference server evaluates in one forward pass
+INFERENCE_TIMEOUT = 0.002  # Seconds the inference server waits for more states before evaluating a batch
+INFERENCE_CACHE_SIZE = 2**20  # Number of positions whose network outputs are kept, cleared after training
 
 # ====================== Paths =======================
 MCTS_PERSONAL_DATA_FILE = "data_file.csv"  # Name of the file containing the data
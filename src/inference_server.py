@@ -0,0 +1,165 @@
+import queue
+from time import time
+import torch
+import torch.multiprocessing as mp
+import config
+from neural_network import InferenceCache, NeuralNet, PendingValues
+
+# Policy of this worker process, set by init_worker
+worker_policy: "RemotePolicy" = None
+
+
+class InferenceServerError(RuntimeError):
+    """
+    Raised in a client when the server failed to evaluate its states
+    """
+
+
+class InferenceServer:
+    """
+    Runs one NeuralNet in its own process and evaluates the states sent by the self-play workers.
+    Requests are gathered until max_batch_size states are waiting or timeout seconds have passed,
+    then all of them are evaluated in one forward pass.
+    """
+    def __init__(self, model: NeuralNet, num_clients: int, max_batch_size: int = config.INFERENCE_BATCH_SIZE, timeout: float = config.INFERENCE_TIMEOUT):
+        context = mp.get_context("spawn")
+        self._requests = context.Queue()
+        # One response queue for each client, so every client only gets its own answers
+        self._responses = [context.Queue() for _ in range(num_clients)]
+        self._next_client_id = context.Value("i", 0)
+
+        # Includes the int8 copy if the model is quantized
+        self._process = context.Process(target=_serve, args=(model.get_process_state(), self._requests, self._responses,
+                                                             max_batch_size, timeout), daemon=True)
+
+    def start(self) -> None:
+        self._process.start()
+
+    def stop(self) -> None:
+        """
+        Stops the server process after it has answered the requests already sent
+        """
+        self._requests.put(None)
+        self._process.join()
+
+    def get_worker_initializer(self) -> "tuple[callable, tuple]":
+        """
+        Returns the initializer and its arguments for a process pool, giving every worker its own RemotePolicy.
+        The queues can only be given to the workers when they are created.
+        """
+        return init_worker, (self._requests, self._responses, self._next_client_id)
+
+    def __enter__(self) -> "InferenceServer":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+class RemotePolicy:
+    """
+    Used by the self-play workers instead of a NeuralNet. It has the same inference methods,
+    but the forward pass is done by the InferenceServer.
+    """
+    predict = NeuralNet.predict
+    predict_batch = NeuralNet.predict_batch
+    default_policy = NeuralNet.default_policy
+    get_best_move_index = NeuralNet.get_best_move_index
+    get_cached_value = NeuralNet.get_cached_value
+    clear_cache = NeuralNet.clear_cache
+    # The server copies the states to its device, so the worker never needs a CUDA context
+    input_device = torch.device("cpu")
+
+    def __init__(self, client_id: int, requests: mp.Queue, responses: mp.Queue) -> None:
+        self._client_id = client_id
+        self._requests = requests
+        self._responses = responses
+        self._value_cache = InferenceCache()
+        self._move_cache = InferenceCache()
+
+    def predict_batch_async(self, x: torch.Tensor, keys: list[int] = None) -> PendingValues:
+        """
+        The server answers before infer returns, so the values are ready at once
+        """
+        cache = self._value_cache if keys is not None else None
+        return PendingValues(self.infer(x)[1], cache=cache, keys=keys)
+
+    def infer(self, x: torch.Tensor) -> "tuple[torch.Tensor, torch.Tensor]":
+        """
+        Sends the states to the server and waits for the policy and value.
+        Raises InferenceServerError if the server failed to evaluate them.
+        """
+        self._requests.put((self._client_id, x.cpu()))
+        response = self._responses.get()
+        if isinstance(response, InferenceServerError):
+            raise response
+        return response
+
+
+def init_worker(requests: mp.Queue, responses: "list[mp.Queue]", next_client_id) -> None:
+    """
+    Gives the worker process a RemotePolicy with the next free response queue
+    """
+    global worker_policy
+    with next_client_id.get_lock():
+        client_id = next_client_id.value
+        next_client_id.value += 1
+    worker_policy = RemotePolicy(client_id, requests, responses[client_id])
+
+
+def _serve(process_state: tuple, requests: mp.Queue, responses: "list[mp.Queue]", max_batch_size: int, timeout: float) -> None:
+    """
+    Main loop of the server process. Stops when None is received.
+    Errors are sent to the clients of the failed batch, so they raise instead of waiting forever.
+    """
+    try:
+        model = NeuralNet.from_process_state(process_state)
+        load_error = None
+    except Exception as error:
+        # Every request gets the error instead of an answer
+        model, load_error = None, error
+
+    running = True
+    while running:
+        request = requests.get()
+        if request is None:
+            break
+        batch = [request]
+        batch_size = len(request[1])
+
+        # Wait a short time for more requests to fill the batch
+        deadline = time() + timeout
+        while batch_size < max_batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                request = requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                running = False
+                break
+            batch.append(request)
+            batch_size += len(request[1])
+
+        try:
+            if load_error is not None:
+                raise load_error
+            x = torch.cat([states for _, states in batch]).to(config.DEVICE)
+            policy, value = model.infer(x)
+            policy, value = policy.cpu(), value.cpu()
+        except Exception as error:
+            # Sent as an InferenceServerError with the message, the original exception might not be picklable
+            server_error = InferenceServerError(f"Inference server failed: {error!r}")
+            for client_id, _ in batch:
+                responses[client_id].put(server_error)
+            continue
+
+        # Send every client its part of the output
+        start = 0
+        for client_id, states in batch:
+            end = start + len(states)
+            responses[client_id].put((policy[start:end].clone(), value[start:end].clone()))
+            start = end
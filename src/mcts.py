@@ -1,111 +1,173 @@
 # Dependencies
-import copy
 import math
+import random
 import config
 from time import time
 import numpy as np
 from node import Node
+from mcts_core import best_child_index
 from chess_handler import ChessStateHandler
 from state import StateHandler
-import random
-from neural_network import NeuralNet, transform_2d_to_tensor
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from neural_network import NeuralNet, PendingValues, transform_2d_to_tensor
+import inference_server
+from inference_server import InferenceServer
 import torch
 from game_data import GameData
-import sys
 
+# Random numbers of the search, seeded by each self-play worker
+rng = random.Random()
+# Exploration parameter c of the upper confidence bound
+_EXPLORATION_PARAMETER = math.sqrt(2)
 
-def monte_carlo_tree_search(root: Node, policy: NeuralNet =None, max_itr=0, max_time=0) -> Node:
+
+def monte_carlo_tree_search(root: Node, policy: NeuralNet =None, max_itr=0, max_time=0, batch_size=config.MCTS_BATCH_SIZE) -> Node:
     """
     Runs the monte carlo tree search algorithm.
     If max_itr is 0, it will run until max_time is reached, else it will run for max_itr iterations.
+    The leaves are collected in batches of batch_size and evaluated together. On a GPU the next batch is selected
+    while the previous one is evaluated, so the forward pass overlaps with the selection.
     Returns the root node of the tree generated with the given root.
     """
+    pending_batch: PendingBatch = None
     if max_itr == 0:
-        start_time = time.time()
-        while time.time() - start_time < max_time:
-            chosen_node: Node = selection(root)
-            created_node: Node = expansion(chosen_node)
-            result: int = simulation(created_node, policy) # TODO ADD SIGMA TO SIMULATION
-            backpropagation(created_node, result)
+        start_time = time()
+        while time() - start_time < max_time:
+            pending_batch = run_batch(root, policy, batch_size, pending_batch)
     else:
         itr = 0
         while itr < max_itr:
-            chosen_node: Node = selection(root)
-            created_node = expansion(chosen_node)
-            result = simulation(created_node, policy)
-            backpropagation(created_node, result)
-            itr += 1
+            size = min(batch_size, max_itr - itr)
+            pending_batch = run_batch(root, policy, size, pending_batch)
+            itr += size
+    finish_batch(pending_batch)
 
     return root
 
 
-def selection(node: Node) -> Node:
+# Leaves of a batch, their results, the indices of the results still being predicted and the pending prediction
+PendingBatch = tuple[list[Node], list[float], list[int], PendingValues]
+
+
+def run_batch(root: Node, policy: NeuralNet=None, batch_size: int=config.MCTS_BATCH_SIZE, previous_batch: PendingBatch=None) -> PendingBatch:
+    """
+    Selects and expands batch_size leaves and starts evaluating all of them at once, then the previous batch is finished.
+    If the values are still being computed on the GPU, the new batch is returned to be finished by the next call or finish_batch.
+    Otherwise it is finished at once and None is returned.
+    Virtual loss is added to the path of every collected leaf, so the next selection prefers another path.
+    The state of the root is stepped down to each leaf and back again, so no state is copied.
+    """
+    state: StateHandler = root.get_state()
+    leaves: list[Node] = []
+    results: list[float] = []
+    unfinished: list[int] = []
+    features: list[torch.Tensor] = []
+    keys: list[int] = []
+    for i in range(batch_size):
+        chosen_node: Node = selection(root, state)
+        created_node: Node = expansion(chosen_node, state)
+        add_virtual_loss(created_node)
+        leaves.append(created_node)
+
+        # Finished games use the winner, the rest are predicted by the value head after the loop
+        if state.is_finished():
+            results.append(state.get_winner())
+        elif policy is None:
+            results.append(simulation(state))
+        else:
+            # Transpositions already evaluated use the cached value
+            key, value = policy.get_cached_value(state)
+            if value is not None:
+                results.append(value)
+            else:
+                results.append(0)
+                unfinished.append(i)
+                keys.append(key)
+                # Kept on the cpu, the whole batch is copied to the device at once
+                features.append(transform_2d_to_tensor(state, device=torch.device("cpu")))
+        step_back_to_root(created_node, root, state)
+
+    values: PendingValues = None
+    if unfinished:
+        values = policy.predict_batch_async(torch.cat(features), keys)
+
+    finish_batch(previous_batch)
+    batch = (leaves, results, unfinished, values)
+    if values is None or not values.is_pending():
+        # Nothing to overlap with, so the next selection uses the results of this batch
+        finish_batch(batch)
+        return None
+    return batch
+
+
+def finish_batch(batch: PendingBatch) -> None:
+    """
+    Waits for the predicted values of the batch and backpropagates the results.
+    """
+    if batch is None:
+        return
+    leaves, results, unfinished, values = batch
+    if values is not None:
+        for i, value in zip(unfinished, values.get()):
+            results[i] = value
+
+    backpropagation_batch(leaves, results)
+
+
+def step_back_to_root(node: Node, root: Node, state: StateHandler) -> None:
+    """
+    Undoes the moves done on state from root down to node.
+    """
+    while node is not root:
+        state.step_back()
+        node = node.get_parent()
+
+
+def add_virtual_loss(node: Node) -> None:
+    """
+    Marks the path from node to the root as having a pending evaluation.
+    """
+    while node is not None:
+        node.add_in_flight()
+        node = node.get_parent()
+
+
+def selection(node: Node, state: StateHandler=None) -> Node:
     '''
     This selects the best leaf for expansion.
     For Monte Carlo this is the node that you should expand.
     Given by exploration and exploitation means.
+    If a state is given, the moves down to the selected node are done on it.
     '''
-    child_nodes = node.get_children()
-    best_child = None
-    best_node_value = 0
-
-    while child_nodes:
-        for child_node in child_nodes:
-            if (best_node_value < ucb(child_node)):
-                best_child = child_node
-                best_node_value = ucb(child_node)
-        if best_child is None:
+    while node.is_expanded() and node.get_children_moves():
+        best_index = best_child_index(node.get_children_wins(), node.get_children_visits(), node.get_children_in_flight(),
+                                      node.get_visits() + node.get_n_in_flight(), config.VIRTUAL_LOSS, _EXPLORATION_PARAMETER)
+        # Stop when the best child is not expanded yet, all of those have the same upper confidence bound
+        if not node.has_child(best_index):
             break
-        return selection(best_child)
+        node = node.get_child(best_index)
+        if state is not None:
+            state.step(node.get_move())
     return node
 
-def expansion(node: Node) -> Node:
+def expansion(node: Node, state_handler: StateHandler) -> Node:
     """
-    Generates a new child to node. It is generated by making a random move, 
-    checking if that move has a corresponding child, if not it generates a child with the random move.
-    Repeats until a child is generated
+    Generates a new child to node, where state_handler is the state of node.
+    The children arrays of node are created the first time, then a random move which does not have a
+    corresponding child yet is chosen. The move is done on state_handler and only the move is stored in the child.
+    Returns node if every move already has a child.
     """
-    state_handler: StateHandler = node.get_state()
-    moves = state_handler.get_legal_actions()
-    
-    if (len(node.get_children()) == 0):  
-        rand_move = random.choice(moves)
-        state_handler.step(rand_move)
-        child_node = Node(copy.deepcopy(state_handler))
-        node.add_child(child_node)
-        state_handler.step_back()
-        return child_node
-    else:
-        while True:
-            rand_move = random.choice(moves)
-            state_handler.step(rand_move)
-            child_node = Node(copy.deepcopy(state_handler))
-            # If the child is already added, make another child.
-            root_children_board_states = [child_node.get_state().get_board_state() for child_node in node.get_children()]
-            
-            if (child_node.get_state().get_board_state() not in root_children_board_states):
-                node.add_child(child_node)
-                state_handler.step_back()
-                return child_node
-    
-    '''
-    for move in moves:
-        state_handler.step(move)
-        child_node = Node(copy.deepcopy(state_handler))
-        node.add_child(child_node)
-        state_handler.step_back()
-
-        
-    # TODO: Make use of default policy
-    if node.get_children():
-        child_node = random.choice(node.get_children())
-        return child_node
-    
-    else:
+    if not node.is_expanded():
+        node.expand(state_handler.get_legal_actions())
+    untried_indices = node.get_untried_indices()
+    if not untried_indices:
         return node
-    '''
-
 
+    child_node = node.get_child(untried_indices.pop(rng.randrange(len(untried_indices))))
+    state_handler.step(child_node.get_move())
+    return child_node
 
 
 def choose_move(game: StateHandler, policy: NeuralNet=None):
@@ -123,84 +185,107 @@ def _make_random_move(game: StateHandler):
     Chooses a random move for the given game.
     """
     legal_actions = game.get_legal_actions()
-    index = random.randint(0, len(legal_actions)-1)
+    index = rng.randrange(len(legal_actions))
     move = legal_actions[index]
     return move
 
-def simulation(node: Node, policy: NeuralNet=None) -> int:
+def simulation(state: StateHandler, policy: NeuralNet=None) -> float:
     """
     In this process, a simulation is performed by choosing moves or strategies until a result or predefined state is achieved.
+    The moves are done on state and taken back before returning, so state is left unchanged.
     """
-    state = copy.deepcopy(node.get_state())
+    result: float = None
+    pushed = 0
     while not state.is_finished():
         state.step(choose_move(state, policy))  # TODO refactor
+        pushed += 1
 
-        if random.random() < config.SIGMA and policy is not None:
+        if rng.random() < config.SIGMA and policy is not None:
             predicted_winner = policy.predict(state) # TODO: CHECK IF THIS IS UNDERSTANDABLE BY OTHERS
             # print("Winner: " + str(predicted_winner) + " or as " + str(int(predicted_winner)))
-            return int(predicted_winner)
-    return state.get_winner()
+            result = predicted_winner
+            break
+    if result is None:
+        result = state.get_winner()
+
+    for _ in range(pushed):
+        state.step_back()
+    return result
 
 
-def backpropagation(node: Node, result: int) -> None:
+def backpropagation(node: Node, result: float) -> None:
     """
     After determining the value of the newly added node, the remaining tree must be updated. 
     So, the backpropagation process is performed, where it backpropagates from the new node to the root node. 
     During the process, the number of simulation stored in each node is incremented. Also, if the new node’s 
     simulation results in a win, then the number of wins is also incremented.
     """
-    node.add_visits()
-    node.add_reward(result)
-    if not node.has_parent():  # if node is not root, then it has a parent and backpropagates to it
-        backpropagation(node.get_parent(), -result)
+    while node is not None:
+        node.add_visits()
+        node.add_reward(result)
+        # The result is seen from the other player in the parent
+        result = -result
+        node = node.get_parent()
+
+def backpropagation_batch(leaves: list[Node], results: list[float]) -> None:
+    """
+    Backpropagates the results of a batch of leaves and removes their virtual loss,
+    walking each path once and updating each node with a single call.
+    """
+    for node, result in zip(leaves, results):
+        while node is not None:
+            node.add_result(result)
+            # The result is seen from the other player in the parent
+            result = -result
+            node = node.get_parent()
 
 def ucb(node: Node):
     """
-    Takes in node and returns upper confidence bound based on parent node visits and node visits
+    Takes in node and returns upper confidence bound based on parent node visits and node visits.
+    Pending evaluations count as visits with a virtual loss.
     """
-    visits = node.get_visits()
-    parent_visits = node.get_parent().get_visits()
+    in_flight = node.get_n_in_flight()
+    visits = node.get_visits() + in_flight
+    parent_visits = node.get_parent().get_visits() + node.get_parent().get_n_in_flight()
     if visits == 0:
         visits = 1
     if parent_visits == 0:
         parent_visits = 1
 
-    exploration_parameter = math.sqrt(2)
-    exploitation = node.get_wins()/visits
-    exploration = np.sqrt(np.log(parent_visits/visits))
-    return exploitation + exploration_parameter*exploration
+    exploitation = (node.get_wins() - config.VIRTUAL_LOSS*in_flight)/visits
+    # math is much faster than NumPy for single values
+    exploration = math.sqrt(math.log(parent_visits)/visits)
+    return exploitation + _EXPLORATION_PARAMETER*exploration
 
-def softmax(list: list) -> list:
+def softmax(list: list) -> np.ndarray:
     """
-    Takes in a list and returns a list with softmax applied to it
+    Takes in a list and returns an array with softmax applied to it.
+    Computed in place on one float32 copy, after subtracting the max for numerical stability.
     """
-    exp_list = np.exp(list)
-    sum_exp_list = np.sum(exp_list)
-    result = exp_list/sum_exp_list
+    result = np.array(list, dtype=np.float32)
+    result -= result.max()
+    np.exp(result, out=result)
+    result /= result.sum()
     return result
 
-def get_action_probabilities(node: Node) -> list:
+def get_action_probabilities(node: Node) -> np.ndarray:
     """
     Finds the best move to be done by Monte Carlo by Node.
     Should return a vector containing all move probabilities.
     """
-    distributions = []
     #Append simulations
     # TODO: CHECK FOR CORRECT CHILDREN, send children and probability as a pair
     # Check if we need to add wins over visits, while appending children
 
-    i = 0
-    # print(node.get_state().get_actions_mask())
-    for action in node.get_state().get_actions_mask():
-        
-        if (action == 1):
-            if (len(node.get_children()) <= i):
-                distributions.append(0)
-            else:
-                distributions.append(node.get_children()[i].get_visits())
-            i += 1
-        else:
-            distributions.append(-100)
+    mask = node.get_state().get_actions_mask()
+    # Illegal actions get -100, legal actions get the visits of their child in order, or 0 without a child
+    distributions = np.full(len(mask), -100, dtype=np.float32)
+    legal_indices = np.flatnonzero(mask == 1)
+    distributions[legal_indices] = 0
+    children_visits = node.get_children_visits()
+    if children_visits is not None:
+        amount = min(len(legal_indices), len(children_visits))
+        distributions[legal_indices[:amount]] = children_visits[:amount]
 
     # Softmax of result
     distributions = softmax(distributions)
@@ -227,51 +312,125 @@ def get_best_action(node: Node) -> Node:
     
     return best_node
 
-def generate_test_data(start_node: Node, num_games: int, rounds: int, model: NeuralNet = None):
+def play_game(game: StateHandler, rounds: int, model: NeuralNet = None) -> list[tuple[np.ndarray, np.ndarray, float]]:
     """
-    Generates test data for the neural network
+    Plays one game from the state game, running monte carlo tree search with rounds simulations before each move.
+    Returns the state, distribution and expected outcome probability for every move. The moves are taken back
+    at the end, so game is left unchanged.
     """
-    #state = node.get_state().get_board_state()
-    # start_node = start_node
+    root = Node(game)
+    moves_played = 0
+    game_data = []
     
-    for game_iteration in range(num_games):
-        root = Node(start_node.get_state())
-        game: StateHandler = root.get_state() # Initialize the actual game board (B_a) to an empty board
-        print("Iteration: " + str(game_iteration+1))
+    while not game.is_finished() and root != None:
+        monte_carlo_tree_search(root, model, rounds) 
+        player = game.get_current_player()
+
+        state = root.get_state().get_board_state()
+        # Add the player to the start point of state
+        state = np.insert(state, 0, player)
+        # print("Player in state: " + str(player))
+
+        distribution = get_action_probabilities(root)
+        distribution = np.asarray(distribution, dtype=np.float32)
+        # print("state: " + str(state) + " distribution: " + str(distribution))
+
+        # Find expected outcome probability
+        expected_outcome_probability = root.calculate_value()
+
+        game_data.append((state, distribution, expected_outcome_probability))
+        
+        # Choose actual move (a*) based on distribution
+        best_move_root: Node = get_best_action(root)
+        root = best_move_root
+        # Remove parent from root and hand it the game, only the moves are stored in the tree
+        root.remove_parent()
+        game.step(root.get_move())
+        moves_played += 1
+        root.set_state(game)
         game.render()
+        print("Visits: " + str(root.get_visits()))
         print("")
-        
-        while not game.is_finished() and root != None:
-            monte_carlo_tree_search(root, model, rounds) 
-            player = game.get_current_player()
 
-            state = root.get_state().get_board_state()
-            # Add the player to the start point of state
-            state = np.insert(state, 0, player)
-            # print("Player in state: " + str(player))
+    # Take back the moves of the game, so the next game starts from the start state
+    for _ in range(moves_played):
+        game.step_back()
+    return game_data
 
-            distribution = get_action_probabilities(root)
-            distribution = np.asarray(distribution, dtype=np.float32)
-            # print("state: " + str(state) + " distribution: " + str(distribution))
+# Model of this self-play worker process, set by _init_worker
+worker_model: NeuralNet = None
 
-            # Find expected outcome probability
-            expected_outcome_probability = root.calculate_value()
 
-            GameData.add_data_to_replay_buffer(state, distribution, expected_outcome_probability)
-            
-            # Choose actual move (a*) based on distribution
-            best_move_root: Node = get_best_action(root)
-            root = best_move_root
-            # Remove parent from root
-            root.remove_parent()
-            game = root.get_state()
-            game.render()
-            print("Visits: " + str(root.get_visits()))
+def _init_worker(process_state: tuple = None) -> None:
+    """
+    Runs once in every worker process. Rebuilds the model from NeuralNet.get_process_state,
+    so it is sent and loaded once for each worker instead of once for each game.
+    """
+    global worker_model
+    if process_state is not None:
+        worker_model = NeuralNet.from_process_state(process_state)
+
+def _play_one_game(seed: int, start_state: StateHandler, rounds: int) -> list[tuple[np.ndarray, np.ndarray, float]]:
+    """
+    Plays one game in a worker process, with the model of the worker or its InferenceServer.
+    Without either the game is played without a model.
+    """
+    rng.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    # One thread for each worker, the games already run in parallel
+    torch.set_num_threads(1)
+
+    # Workers of a pool started with an InferenceServer send their states to it
+    model = inference_server.worker_policy
+    if model is None:
+        model = worker_model
+    return play_game(start_state, rounds, model)
+
+def generate_test_data(start_node: Node, num_games: int, rounds: int, model: NeuralNet = None):
+    """
+    Generates test data for the neural network.
+    The games are independent, so they are played in parallel by config.NUM_WORKERS processes.
+    With config.USE_INFERENCE_SERVER the workers share one model in an InferenceServer, instead of each holding a copy.
+    """
+    #state = node.get_state().get_board_state()
+    # start_node = start_node
+    start_state: StateHandler = start_node.get_state()
+    num_workers = min(num_games, config.NUM_WORKERS)
+
+    if num_workers <= 1:
+        all_game_data = []
+        for game_iteration in range(num_games):
+            print("Iteration: " + str(game_iteration+1))
+            start_state.render()
             print("")
+            all_game_data.append(play_game(start_state, rounds, model))
+    else:
+        print("Playing " + str(num_games) + " games with " + str(num_workers) + " workers")
+        seeds = [rng.randrange(2**32) for _ in range(num_games)]
+        server: InferenceServer = None
+        initializer, initargs = _init_worker, (None,)
+        if model is not None and config.USE_INFERENCE_SERVER:
+            server = InferenceServer(model, num_workers)
+            server.start()
+            initializer, initargs = server.get_worker_initializer()
+        elif model is not None:
+            initargs = (model.get_process_state(),)
+        # Spawn instead of fork, CUDA can not be used in forked processes
+        try:
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=initializer, initargs=initargs) as executor:
+                all_game_data = list(executor.map(partial(_play_one_game, start_state=start_state, rounds=rounds), seeds))
+        finally:
+            if server is not None:
+                server.stop()
+
+    for game_data in all_game_data:
+        for state, distribution, expected_outcome_probability in game_data:
+            GameData.add_data_to_replay_buffer(state, distribution, expected_outcome_probability)
 
 
 if __name__ == "__main__":
-    sys.setrecursionlimit(5000)
     # game = ChessStateHandler()
     # node = Node(game.get_state())
 
@@ -284,7 +443,6 @@ if __name__ == "__main__":
     # print(expanded_node.get_state())
     
     print("Test generate test data:")
-    print(sys.getrecursionlimit())
     chessHandler = ChessStateHandler()
 
     # Create a Neural Network
@@ -0,0 +1,55 @@
+import math
+import numpy as np
+
+# Numba is optional, without it the upper confidence bounds are computed with NumPy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def ucb_values(children_wins: np.ndarray, children_visits: np.ndarray, children_in_flight: np.ndarray,
+               parent_visits: int, virtual_loss: float, exploration_parameter: float) -> np.ndarray:
+    """
+    Returns the upper confidence bound of every child, given the children arrays of the parent.
+    Pending evaluations count as visits with a virtual loss.
+    """
+    visits = np.maximum(children_visits + children_in_flight, 1)
+    exploitation = (children_wins - virtual_loss*children_in_flight)/visits
+    exploration = np.sqrt(np.log(max(parent_visits, 1))/visits)
+    return exploitation + exploration_parameter*exploration
+
+
+def _best_child_index(children_wins: np.ndarray, children_visits: np.ndarray, children_in_flight: np.ndarray,
+                      parent_visits: int, virtual_loss: float, exploration_parameter: float) -> int:
+    """
+    Returns the index of the child with the highest upper confidence bound.
+    Goes through the children arrays once, without creating temporary arrays. Compiled by numba.
+    """
+    log_parent_visits = math.log(max(parent_visits, 1))
+    best_index = 0
+    best_value = -math.inf
+    for i in range(children_visits.shape[0]):
+        in_flight = children_in_flight[i]
+        visits = max(children_visits[i] + in_flight, 1)
+        value = (children_wins[i] - virtual_loss*in_flight)/visits + exploration_parameter*math.sqrt(log_parent_visits/visits)
+        if value > best_value:
+            best_value = value
+            best_index = i
+    return best_index
+
+
+def _best_child_index_numpy(children_wins: np.ndarray, children_visits: np.ndarray, children_in_flight: np.ndarray,
+                            parent_visits: int, virtual_loss: float, exploration_parameter: float) -> int:
+    """
+    Returns the index of the child with the highest upper confidence bound, used when numba is not installed.
+    """
+    values = ucb_values(children_wins, children_visits, children_in_flight, parent_visits, virtual_loss, exploration_parameter)
+    return int(np.argmax(values))
+
+
+if njit is not None:
+    best_child_index = njit(cache=True)(_best_child_index)
+else:
+    best_child_index = _best_child_index_numpy
+
@@ -1,17 +1,26 @@
 
+import copy
+import io
+from collections import OrderedDict
 import random
 import torch
 import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
 import numpy as np
 import config as config
 from state import StateHandler
 
 class NeuralNet(nn.Module):
+    # Device the inputs of predict and default_policy are made on
+    input_device: torch.device = config.DEVICE
+
     def __init__(self, num_residual_blocks=config.NUM_RESIDUAL_BLOCKS, num_filters=config.NUM_FILTERS, module_iterations_trained:int= None):
         super(NeuralNet, self).__init__()
 
         self.input_conv = nn.Sequential(
-            nn.Conv2d(config.INPUT_SIZE, num_filters, kernel_size=(3, 1), padding=(1, 0)),
+            # The board is a single channel, copying it to INPUT_SIZE channels gives the same result for INPUT_SIZE times the work
+            nn.Conv2d(1, num_filters, kernel_size=(3, 1), padding=(1, 0)),
             nn.BatchNorm2d(num_filters),
             nn.ReLU(inplace=True)
         )
@@ -40,8 +49,23 @@ class NeuralNet(nn.Module):
         if module_iterations_trained is not None:
             self.module_iterations_trained = module_iterations_trained
         self.module_iterations_trained = "No Name"
+        # int8 copy of the network used by infer, set by quantize
+        self._quantized_model: nn.Module = None
+        # Copy of the network with the BatchNorm layers folded into the convolutions, made by infer
+        self._fused_model: nn.Module = None
+        # Outputs for positions seen before, so transpositions skip the forward pass
+        self._value_cache = InferenceCache()
+        self._move_cache = InferenceCache()
+        # channels_last lets cuDNN use its fused convolution kernels
+        self.to(config.DEVICE, memory_format=torch.channels_last)
+        # The model is used for inference by default, train() is called before training
+        self.eval()
+        if config.COMPILE_MODEL:
+            # Compiles the forward pass in place, fusing the layers of each block into fewer kernels
+            self.compile(mode="reduce-overhead")
 
     def forward(self, x: torch.Tensor):
+        x = x.contiguous(memory_format=torch.channels_last)
         x = self.input_conv(x)
         x = self.residual_blocks(x)
         policy = self.policy_head(x)
@@ -52,70 +76,226 @@ class NeuralNet(nn.Module):
         """
         Predicts the value of the given state using the neural network. 
         """
-        x: torch.Tensor = transform_2d_to_tensor(state).to(config.DEVICE)
-        value = self.forward(x)[1] # Get the value from the forward pass
-        return value.item()
-    
-    def softmax(x: torch.Tensor ) -> np.array:
-        # Subtract the maximum value to avoid numerical issues with large exponents
-        e_x = np.exp(x - np.max(x))
+        key = state.zobrist_hash()
+        value = self._value_cache.get(key)
+        if value is None:
+            x: torch.Tensor = transform_2d_to_tensor(state, device=self.input_device)
+            value = self.infer(x)[1].item() # Get the value from the forward pass
+            self._value_cache.put(key, value)
+        return value
+
+    def get_cached_value(self, state: StateHandler) -> "tuple[int, float]":
+        """
+        Returns the zobrist hash of the state and its cached value, the value is None if the state is not cached.
+        """
+        key = state.zobrist_hash()
+        return key, self._value_cache.get(key)
+
+    def clear_cache(self) -> None:
+        """
+        Removes the cached outputs and the fused copy of the network, must be called when the weights change
+        """
+        self._value_cache.clear()
+        self._move_cache.clear()
+        object.__setattr__(self, "_fused_model", None)
+
+    def load_state_dict(self, *args, **kwargs):
+        result = super().load_state_dict(*args, **kwargs)
+        self.clear_cache()
+        return result
 
-        # Compute softmax values
-        return e_x / np.sum(e_x, axis=0)
+    def predict_batch(self, x: torch.Tensor) -> list[float]:
+        """
+        Predicts the values of a batch of states, given as transformed tensors stacked along the first dimension,
+        using one forward pass for all of them.
+        """
+        return self.predict_batch_async(x).get()
 
+    def predict_batch_async(self, x: torch.Tensor, keys: list[int] = None) -> "PendingValues":
+        """
+        Starts predicting the values of a batch of states, without waiting for the result.
+        On a GPU the batch is copied through a pinned buffer and the forward pass runs on a side stream,
+        so the caller can keep working until PendingValues.get is called.
+        If the zobrist hashes of the states are given as keys, the values are cached when they are ready.
+        """
+        cache = self._value_cache if keys is not None else None
+        if config.DEVICE.type != "cuda" or self._quantized_model is not None:
+            return PendingValues(self.infer(x.to(config.DEVICE))[1], cache=cache, keys=keys)
+
+        if config.FUSE_BATCH_NORM:
+            # Made before switching streams, the fused weights are also used on the default stream by predict and default_policy
+            self._get_fused_model()
+        stream = _get_inference_stream()
+        # The side stream must not start before the work already queued on the default stream
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            x = _copy_to_device(x)
+            values = self.infer(x)[1]
+            done = torch.cuda.Event()
+            done.record(stream)
+        return PendingValues(values, done, cache, keys)
+
+    def infer(self, x: torch.Tensor) -> "tuple[torch.Tensor, torch.Tensor]":
+        """
+        Runs the forward pass for inference. Inference mode skips building the autograd graph,
+        and on GPUs supporting it the network runs in bfloat16.
+        Uses the int8 copy of the network if the model is quantized.
+        Returns policy and value as float32.
+        """
+        if self._quantized_model is not None:
+            # Quantized layers only run on the cpu
+            with torch.inference_mode():
+                return self._quantized_model(x.cpu())
+        model = self._get_fused_model() if config.FUSE_BATCH_NORM else self
+        with torch.inference_mode(), torch.autocast(config.DEVICE.type, dtype=torch.bfloat16, enabled=config.USE_BF16):
+            policy, value = model(x)
+        return policy.float(), value.float()
     
     def default_policy(self, game: StateHandler, training: bool= False ) -> any:
         """
-        Default policy finds the best move from the model
+        Default policy finds the best move from the model.
+        When training, the move is sampled from the policy instead.
         """
-        state = game.get_board_state()
-        state = state.flatten()
-        # Add the turn indicator
-        state = np.insert(state, 0, game.get_current_player())
-        state: torch.Tensor = transform_2d_to_tensor(game).to(config.DEVICE)
-
-        # print("State: ", state)
         # Find the correct move from the legal games and return it
         # Use the mask and legal moves to find the correct move
         legal_moves = game.get_legal_actions()
-        mask = game.get_actions_mask()
-        best_move_index = self.get_best_move_index(state, game)
-        
-        # best_move_index = 5, [0,1,0,0,0,1,1]
-        # legal_moves = [1, 2, 3]
+        key = game.zobrist_hash()
+        # The legal moves are the same every time the position is reached, so their index can be cached.
+        # Sampled moves are not cached.
+        converted_index = None if training else self._move_cache.get(key)
+        if converted_index is None:
+            state: torch.Tensor = transform_2d_to_tensor(game, device=self.input_device)
+            mask = game.get_actions_mask()
+            best_move_index = self.get_best_move_index(state, game, mask, sample=training)
 
-        converted_index = 0
-        for i in range(best_move_index):
-            if mask[i] == 1:
-                converted_index += 1
+            # best_move_index = 5, [0,1,0,0,0,1,1]
+            # legal_moves = [1, 2, 3]
+
+            # The index among the legal moves is the number of legal moves before best_move_index
+            converted_index = int(np.count_nonzero(mask[:best_move_index]))
+            if not training:
+                self._move_cache.put(key, converted_index)
 
         best_move = legal_moves[converted_index]
         return best_move
 
-    def get_best_move_index(self, state: torch.Tensor, game: StateHandler) -> int:
-        """Get the best move from the model"""
-        # Disable gradient calculation to speed up the process
-        with torch.no_grad():
-            # print("Getting best move")
-            # print("State: ", state)
-            output: torch.Tensor = self(state)
-            output = output[0]
-            # print("Output: ", output)
-            
-            # Convert to numpy array and by correct device
-            np_arr: np.array
-            if config.DEVICE == "cuda":
-                np_arr: np.array = output.detach().cuda().numpy().astype(np.float32)
-            else:
-                np_arr: np.array = output.detach().cpu().numpy().astype(np.float32)
-
-            # Compute softmax
-            result = NeuralNet.softmax(np_arr)
-            # Mask the array with the actions that are not allowed
-            np_arr = result * game.get_actions_mask()
-            # Get the index of the best move
-            index = np.argmax(np_arr)
-            return index
+    def get_best_move_index(self, state: torch.Tensor, game: StateHandler, mask: np.ndarray = None, sample: bool = False) -> int:
+        """
+        Get the best move from the model, or a move sampled from the policy if sample is True.
+        The output is masked on the device it was computed on, only the index is copied back.
+        """
+        policy: torch.Tensor = self.infer(state)[0][0]
+        if mask is None:
+            mask = game.get_actions_mask()
+        legal = torch.as_tensor(mask, device=policy.device) != 0
+        if not legal.any():
+            # None of the legal moves are in ALL_POSSIBLE_MOVES, e.g. when the only legal moves are promotions
+            return 0
+
+        if sample:
+            # The policy head ends with softmax, so the masked output can be sampled from directly
+            index = torch.multinomial(policy.masked_fill(~legal, 0), 1)
+        else:
+            # Softmax keeps the order, so the best legal move is the argmax of the masked output
+            index = policy.masked_fill(~legal, -torch.inf).argmax()
+        return int(index.item())
+
+    def quantize(self, features: list[torch.Tensor]) -> None:
+        """
+        Makes an int8 copy of the network for inference, calibrated on the given features (e.g. GameData.features).
+        Conv, BatchNorm and ReLU layers are fused before converting, the Softmax and Tanh of the heads stay float32.
+        Training still uses the float32 weights, so quantize again after training.
+        """
+        calibration_input = torch.stack([torch.as_tensor(feature, dtype=torch.float32).flatten() for feature in features])
+        calibration_input = calibration_input.view(-1, 1, config.INPUT_SIZE, 1)
+
+        prepared_model = self._prepare_quantization(calibration_input[:1])
+        with torch.inference_mode():
+            # Record the ranges of the activations
+            for batch in torch.split(calibration_input, config.BATCH_SIZE):
+                prepared_model(batch)
+        # Set without registering it as a submodule, so the state dict only holds the float32 weights
+        object.__setattr__(self, "_quantized_model", convert_fx(prepared_model))
+
+    def get_quantized_state(self) -> bytes:
+        """
+        Returns the state dict of the int8 copy saved with torch.save, or None if the network is not quantized.
+        Saved as bytes, because quantized tensors lose their quantization when sent to another process directly.
+        """
+        if self._quantized_model is None:
+            return None
+        buffer = io.BytesIO()
+        torch.save(self._quantized_model.state_dict(), buffer)
+        return buffer.getvalue()
+
+    def load_quantized_state(self, quantized_state: bytes) -> None:
+        """
+        Makes the int8 copy of the network from the result of get_quantized_state of a network with the same float32 weights,
+        so another process can use the quantization without calibrating again.
+        """
+        state_dict = torch.load(io.BytesIO(quantized_state))
+        prepared_model = self._prepare_quantization(torch.zeros(1, 1, config.INPUT_SIZE, 1))
+        quantized_model = convert_fx(prepared_model)
+        # The state dict holds the scales and zero points found when calibrating
+        quantized_model.load_state_dict(state_dict)
+        object.__setattr__(self, "_quantized_model", quantized_model)
+
+    def _prepare_quantization(self, example_input: torch.Tensor) -> nn.Module:
+        """
+        Returns a copy of the network prepared for quantization, with observers recording the ranges of the activations
+        """
+        # The outputs change
+        self.clear_cache()
+        float_model = self._copy_network().cpu().eval()
+        # Configured for the engine that runs the quantized layers on this machine, e.g. x86 or qnnpack on ARM
+        qconfig_mapping = (get_default_qconfig_mapping(torch.backends.quantized.engine)
+                           .set_module_name("policy_head.5", None)
+                           .set_module_name("value_head.7", None))
+        return prepare_fx(float_model, qconfig_mapping, example_inputs=(example_input,))
+
+    def get_process_state(self) -> tuple:
+        """
+        Returns what another process needs to rebuild the network with from_process_state: the number of residual blocks
+        and filters, the state dict on the cpu and the state of the int8 copy from get_quantized_state.
+        """
+        model_args = (len(self.residual_blocks), self.input_conv[0].out_channels)
+        model_state_dict = {key: value.cpu() for key, value in self.state_dict().items()}
+        return model_args, model_state_dict, self.get_quantized_state()
+
+    @staticmethod
+    def from_process_state(process_state: tuple) -> "NeuralNet":
+        """
+        Rebuilds a network from the result of get_process_state, including the int8 copy if it was quantized
+        """
+        model_args, model_state_dict, quantized_state = process_state
+        model = NeuralNet(*model_args)
+        model.load_state_dict(model_state_dict)
+        if quantized_state is not None:
+            model.load_quantized_state(quantized_state)
+        return model
+
+    def _get_fused_model(self) -> nn.Module:
+        """
+        Returns the copy of the network used for inference, with every BatchNorm folded into the convolution before it.
+        Made from the current weights the first time it is used after clear_cache.
+        """
+        if self._fused_model is None:
+            fused_model = fuse_conv_bn(self._copy_network().eval())
+            if config.COMPILE_MODEL:
+                fused_model.compile(mode="reduce-overhead")
+            # Set without registering it as a submodule, so the state dict only holds the weights being trained
+            object.__setattr__(self, "_fused_model", fused_model)
+        return self._fused_model
+
+    def _copy_network(self) -> "NeuralNet":
+        """
+        Returns a deep copy of the network, without the caches, the inference copies and the compiled forward pass
+        """
+        excluded = [self._value_cache, self._move_cache, self._quantized_model, self._fused_model,
+                    getattr(self, "_compiled_call_impl", None)]
+        # Objects in the memo are not copied, the copy gets None instead
+        memo = {id(value): None for value in excluded if value is not None}
+        return copy.deepcopy(self, memo)
 
     def save_model(self, iteration: int, simulations: int, num_residual_blocks: int, filters: int) -> None:
         """Save the model to a file"""
@@ -134,6 +314,130 @@ class NeuralNet(nn.Module):
         model = model.eval()
         return model
 
+def fuse_conv_bn(model: nn.Module) -> nn.Module:
+    """
+    Folds every BatchNorm2d into the Conv2d registered right before it, and replaces the BatchNorm2d with nn.Identity.
+    Uses the running statistics, so the result is only valid for inference. Changes model in place and returns it.
+    """
+    for module in list(model.modules()):
+        children = list(module.named_children())
+        for (_, conv), (name, batch_norm) in zip(children, children[1:]):
+            if isinstance(conv, nn.Conv2d) and isinstance(batch_norm, nn.BatchNorm2d):
+                _fold_batch_norm(conv, batch_norm)
+                setattr(module, name, nn.Identity())
+    return model
+
+
+def _fold_batch_norm(conv: nn.Conv2d, batch_norm: nn.BatchNorm2d) -> None:
+    """
+    Scales the weights of conv and shifts its bias, so conv gives the output of batch_norm(conv(x))
+    """
+    with torch.no_grad():
+        scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+        if conv.bias is None:
+            conv.bias = nn.Parameter(torch.zeros_like(batch_norm.running_mean))
+        # In place, so the weights keep their memory format
+        conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        conv.bias.sub_(batch_norm.running_mean).mul_(scale).add_(batch_norm.bias)
+
+
+class InferenceCache:
+    """
+    Least recently used cache of network outputs, keyed by the zobrist hash of the position
+    """
+    def __init__(self, max_size: int = config.INFERENCE_CACHE_SIZE):
+        self._entries: OrderedDict = OrderedDict()
+        self._max_size = max_size
+
+    def get(self, key: int) -> any:
+        """
+        Returns the cached output, or None if the position is not cached
+        """
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: int, value) -> None:
+        """
+        Caches the output, removing the least recently used one if the cache is full
+        """
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class PendingValues:
+    """
+    Values of a batch which may still be computed on the GPU
+    """
+    def __init__(self, values: torch.Tensor, done: "torch.cuda.Event" = None, cache: InferenceCache = None, keys: list[int] = None):
+        self._values = values
+        self._done = done
+        self._cache = cache
+        self._keys = keys
+
+    def is_pending(self) -> bool:
+        """
+        Returns True if the values may still be computed on the GPU
+        """
+        return self._done is not None
+
+    def get(self) -> list[float]:
+        """
+        Waits until the values are computed and returns them, caching them if keys were given
+        """
+        if self._done is not None:
+            self._done.synchronize()
+        values = self._values.view(-1).tolist()
+        if self._cache is not None:
+            for key, value in zip(self._keys, values):
+                self._cache.put(key, value)
+        return values
+
+
+# Side stream for the forward passes, and the pinned buffer batches are copied through to the GPU.
+# Created when first used.
+_inference_stream: "torch.cuda.Stream" = None
+_staging_buffer: torch.Tensor = None
+_staging_copy_done: "torch.cuda.Event" = None
+
+
+def _get_inference_stream() -> "torch.cuda.Stream":
+    global _inference_stream
+    if _inference_stream is None:
+        _inference_stream = torch.cuda.Stream()
+    return _inference_stream
+
+
+def _copy_to_device(x: torch.Tensor) -> torch.Tensor:
+    """
+    Copies the cpu tensor x to the GPU through a pinned buffer, on the current stream without blocking.
+    """
+    global _staging_buffer, _staging_copy_done
+    if x.is_cuda:
+        return x
+    if _staging_buffer is None or _staging_buffer.shape[0] < x.shape[0] or _staging_buffer.shape[1:] != x.shape[1:]:
+        _staging_buffer = torch.empty((max(x.shape[0], config.MCTS_BATCH_SIZE), *x.shape[1:]), dtype=torch.float32, pin_memory=True)
+    elif _staging_copy_done is not None:
+        # The previous copy must be done before the buffer is written again
+        _staging_copy_done.synchronize()
+
+    staged = _staging_buffer[:x.shape[0]]
+    staged.copy_(x)
+    x = staged.to(config.DEVICE, non_blocking=True)
+    _staging_copy_done = torch.cuda.Event()
+    _staging_copy_done.record()
+    return x
+
+
 class ResidualBlock(nn.Module):
     """
     
@@ -158,9 +462,10 @@ class ResidualBlock(nn.Module):
         return out
 
 
-def transform_2d_to_tensor(game: StateHandler = None, features: np.array= None) -> torch.Tensor:
+def transform_2d_to_tensor(game: StateHandler = None, features: np.array= None, device: torch.device = config.DEVICE) -> torch.Tensor:
     '''
     Tranforms the board state from 2d to a tensor.
+    The features are given as one channel of height INPUT_SIZE, shaped (batch_size, 1, INPUT_SIZE, 1).
     '''
     if features is None and game is not None:
         features = game.get_board_state()
@@ -173,11 +478,9 @@ def transform_2d_to_tensor(game: StateHandler = None, features: np.array= None)
     else:
         features = features.flatten()
 
-    # Add player to 
-    array_3d = np.stack([features] * config.INPUT_SIZE, axis=0)
-    array_4d = array_3d.reshape(1, config.INPUT_SIZE, config.INPUT_SIZE, 1)
-    # Convert the 4D NumPy array to a PyTorch tensor:
-    input_tensor = (torch.from_numpy(array_4d).float().to(config.DEVICE))
+    # Convert to a PyTorch tensor and view it as (batch_size, num_channels, height, width)
+    input_tensor = torch.as_tensor(features, dtype=torch.float32, device=device)
+    input_tensor = input_tensor.view(-1, 1, config.INPUT_SIZE, 1)
     return input_tensor
 
 if __name__ == "__main__":
@@ -188,10 +491,8 @@ if __name__ == "__main__":
 
     array_1d = np.random.randn(65)
     # Reshape the 1D array into a 4D tensor with shape (1, 1, 65, 1):
-    # array_4d = array_1d.reshape(256, 65, 1, 1)
     # Foremat when reshape: (batch_size, num_channels, height, width)
-    array_3d = np.stack([array_1d] * 65, axis=0)
-    array_4d = array_3d.reshape(1, 65, 65, 1)
+    array_4d = array_1d.reshape(1, 1, 65, 1)
     # Convert the 4D NumPy array to a PyTorch tensor:
     input_tensor = torch.from_numpy(array_4d).float()
     # Create an instance of the NeuralNet class and pass the input tensor to it:
@@ -1,23 +1,38 @@
+import numpy as np
 from state import StateHandler
 
 class Node():
     """
-    A class for the nodes, which among other things contains the board state
+    A class for the nodes in the search tree.
+    The visits and wins of the children are stored in arrays on the parent, and a child node is
+    only created when it is expanded. Only the root holds the board state, the other nodes store the move leading to them.
     """
+    __slots__ = ("_state", "_parent", "_index", "_move", "_visits", "_wins", "_n_in_flight",
+                 "_children_moves", "_children_visits", "_children_wins", "_children_in_flight", "_children_nodes", "_untried_indices")
 
-    def __init__(self, state: StateHandler, parent:"Node"=None) -> None:
+    def __init__(self, state: StateHandler, parent:"Node"=None, move=None) -> None:
         """
-        Main constructor, takes in state and parent node.
-        setting all num values as zero. 
+        Main constructor, takes in state, parent node and the move from parent leading to this node.
+        Only the root needs a state, the states of the other nodes are found by doing the moves from the root.
+        setting all num values as zero.
         """
         # _ makes the variables private
         self._state: StateHandler = state
-        self._parent: "Node" = parent
+        self._parent: "Node" = None
+        # Index of this node in the children arrays of the parent
+        self._index = -1
+        self._move = move
+        # Visits and wins are only used by the root, the other nodes use the arrays of the parent
         self._visits = 0
         self._wins = 0
-        self._draws = 0
-        self._loses = 0
-        self._children = []
+        self._n_in_flight = 0
+        # The children arrays are created when the node is expanded
+        self._children_moves: list = None
+        self._children_visits: np.ndarray = None
+        self._children_wins: np.ndarray = None
+        self._children_in_flight: np.ndarray = None
+        self._children_nodes: list["Node"] = None
+        self._untried_indices: list[int] = None
         if parent is not None:
             parent.add_child(self)
 
@@ -25,25 +40,17 @@ class Node():
         """
         Returns numVisits
         """
-        return self._visits
+        if self._parent is None:
+            return self._visits
+        return int(self._parent._children_visits[self._index])
 
-    def get_wins(self) -> int:
+    def get_wins(self) -> float:
         """
         Returns numWins
         """
-        return self._wins
-
-    def get_draws(self) -> int:
-        """
-        Returns numDraws
-        """
-        return self._draws
-
-    def get_losses(self) -> int:
-        """
-        Returns numLoses
-        """
-        return self._loses
+        if self._parent is None:
+            return self._wins
+        return float(self._parent._children_wins[self._index])
 
     def get_parent(self) -> "Node":
         """
@@ -55,7 +62,7 @@ class Node():
         """
         Returns True if self is leaf (has no children)
         """
-        return bool(len(self._children))
+        return self.has_children()
 
     def is_parent(self) -> bool:
         """
@@ -63,24 +70,118 @@ class Node():
         """
         return bool(self._parent)
 
+    def is_expanded(self) -> bool:
+        """
+        Returns True if the children arrays of the node are created
+        """
+        return self._children_moves is not None
+
+    def expand(self, moves: list) -> None:
+        """
+        Creates the children arrays, with one entry for each of the moves.
+        """
+        amount = len(moves)
+        self._children_moves = list(moves)
+        self._children_visits = np.zeros(amount, dtype=np.int32)
+        self._children_wins = np.zeros(amount, dtype=np.float32)
+        self._children_in_flight = np.zeros(amount, dtype=np.int32)
+        self._children_nodes = [None] * amount
+        self._untried_indices = list(range(amount))
+
     def get_children(self) -> list["Node"]:
         """
-        Returns list of children
+        Returns list of the children that are created
         """
-        return self._children
+        if self._children_nodes is None:
+            return []
+        return [child for child in self._children_nodes if child is not None]
 
     def has_children(self) -> bool:
         """
         Returns True if has children
         """
-        return bool(len(self._children))
+        return bool(len(self.get_children()))
+
+    def get_child(self, index: int) -> "Node":
+        """
+        Returns the child at index in the children arrays, creating it if it does not exist yet
+        """
+        child = self._children_nodes[index]
+        if child is None:
+            child = Node(None, move=self._children_moves[index])
+            child._parent = self
+            child._index = index
+            self._children_nodes[index] = child
+        return child
+
+    def has_child(self, index: int) -> bool:
+        """
+        Returns True if the child at index in the children arrays is created
+        """
+        return self._children_nodes[index] is not None
+
+    def get_untried_indices(self) -> list[int]:
+        """
+        Returns the indices of the children that are not created yet.
+        This is the list kept by the node, expansion removes the index of the child it creates.
+        """
+        return self._untried_indices
+
+    def get_children_moves(self) -> list:
+        """
+        Returns the moves leading to each of the children
+        """
+        return self._children_moves
+
+    def get_children_visits(self) -> np.ndarray:
+        """
+        Returns the visits of each of the children
+        """
+        return self._children_visits
+
+    def get_children_wins(self) -> np.ndarray:
+        """
+        Returns the wins of each of the children
+        """
+        return self._children_wins
+
+    def get_children_in_flight(self) -> np.ndarray:
+        """
+        Returns the pending evaluations of each of the children
+        """
+        return self._children_in_flight
+
+    def add_result(self, result: float) -> None:
+        """
+        Adds a visit and the reward of the result (from -1 to 1), and removes one pending evaluation.
+        Same as add_visits and add_reward, together with undoing add_in_flight, in one call. Used by backpropagation_batch.
+        """
+        # Win gives 1, draw 0.5 and loss 0, predicted values in between, same as add_reward
+        reward = (result + 1) / 2
+        parent = self._parent
+        if parent is None:
+            self._visits += 1
+            self._wins += reward
+            self._n_in_flight -= 1
+        else:
+            index = self._index
+            parent._children_visits[index] += 1
+            parent._children_wins[index] += reward
+            parent._children_in_flight[index] -= 1
 
     def add_child(self, child: "Node") -> None:
         """
         Add a node to children
         """
-        self._children.append(child)
+        if not self.is_expanded():
+            self.expand([])
+        self._children_moves.append(child._move)
+        self._children_visits = np.append(self._children_visits, np.int32(child._visits))
+        self._children_wins = np.append(self._children_wins, np.float32(child._wins))
+        self._children_in_flight = np.append(self._children_in_flight, np.int32(child._n_in_flight))
+        self._children_nodes.append(child)
         child._parent = self
+        child._index = len(self._children_nodes) - 1
 
     def get_state(self) -> StateHandler:
         """
@@ -88,52 +189,90 @@ class Node():
         """
         return self._state
 
-    def set_fully_expanded(self, value: bool) -> None:
+    def set_state(self, state: StateHandler) -> None:
         """
-        Set the value of fully expanded
+        Set the state of the node, used when the node becomes the root
         """
-        self._is_fully_expanded = value
+        self._state = state
+
+    def get_move(self):
+        """
+        Returns the move from the parent leading to this node
+        """
+        return self._move
 
     def set_wins(self, wins) -> None:
         '''
         Set the value of wins
         '''
-        self._wins = wins
+        if self._parent is None:
+            self._wins = wins
+        else:
+            self._parent._children_wins[self._index] = wins
 
     def set_visits(self, visits) -> None:
         '''
         Set the value of visits
         '''
-        self._visits = visits
+        if self._parent is None:
+            self._visits = visits
+        else:
+            self._parent._children_visits[self._index] = visits
 
     def has_parent(self) -> bool:
         return self._parent != None
-    
+
     def remove_parent(self) -> None:
+        """
+        Removes the parent, the values of the node are moved from the arrays of the parent to the node
+        """
+        self._visits = self.get_visits()
+        self._wins = self.get_wins()
+        self._n_in_flight = self.get_n_in_flight()
         self._parent = None
+        self._index = -1
 
     def add_visits(self) -> None:
-        self._visits += 1
+        if self._parent is None:
+            self._visits += 1
+        else:
+            self._parent._children_visits[self._index] += 1
+
+    def get_n_in_flight(self) -> int:
+        """
+        Returns the number of pending evaluations below this node
+        """
+        if self._parent is None:
+            return self._n_in_flight
+        return int(self._parent._children_in_flight[self._index])
+
+    def add_in_flight(self) -> None:
+        if self._parent is None:
+            self._n_in_flight += 1
+        else:
+            self._parent._children_in_flight[self._index] += 1
 
     def add_win(self) -> None:
-        self._wins += 1
+        self._add_wins(1)
 
     def add_draw(self) -> None:
-        self._wins += 0.5
+        self._add_wins(0.5)
+
+    def _add_wins(self, wins: float) -> None:
+        if self._parent is None:
+            self._wins += wins
+        else:
+            self._parent._children_wins[self._index] += wins
 
-    def add_reward(self, reward: int) -> None:
+    def add_reward(self, reward: float) -> None:
         """
-        Adds a reward to the node
+        Adds a reward to the node. 1 is a win, 0 a draw and -1 a loss,
+        values predicted by the network are in between.
         """
-        if reward == 1:
-            self.add_win()
-        elif reward == 0:
-            self.add_draw()
-        elif reward == -1:
-            pass
-        else:
-            raise ValueError("Reward must be 1, 0 or -1")
-    
+        if not -1 <= reward <= 1:
+            raise ValueError("Reward must be between -1 and 1")
+        self._add_wins((reward + 1) / 2)
+
     def calculate_value(self) -> float:
         """
         Calculates the value of the node
@@ -142,5 +281,4 @@ class Node():
         if visits == 0:
             visits = 1
         wins = self.get_wins()
-        losses = self.get_losses()
-        return (wins-losses)/visits
+        return wins/visits
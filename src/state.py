@@ -47,6 +47,13 @@ class StateHandler(ABC):
         """
         pass
 
+    @abstractmethod
+    def zobrist_hash(self) -> int:
+        """
+        Get a 64 bit hash of the position, equal for positions reached by different moves.
+        """
+        pass
+
     @abstractmethod
     def get_board_state(self) -> np.array:
         """
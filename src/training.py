@@ -16,8 +16,6 @@ import cProfile
 from pstats import SortKey
 import pstats
 
-sys.setrecursionlimit(5000)
-
 # 0) Data processing
 train_dataset: GameData
 test_dataset: GameData
@@ -62,6 +60,7 @@ def train_on_data():
     '''
     Trains the model on the data in the data file 
     '''
+    model.train()
     for epoch, (features, labels, expected_outcome_probability) in enumerate(train_loader):
         features = features.to(config.DEVICE)
         labels = labels.to(config.DEVICE)
@@ -78,6 +77,9 @@ def train_on_data():
         optimizer.step()
 
     print(f"EPOCH[{epoch}], loss = {loss.item(): .4f}")
+    # Back to inference for generating data and playing, the cached outputs are from the old weights
+    model.eval()
+    model.clear_cache()
 
 
 
@@ -97,6 +99,9 @@ def train_ANET(iteration: int, rounds: int):
         update_dataset_and_load()
         
         train_on_data()
+        if config.QUANTIZE_MODEL:
+            # The next games are played by the int8 copy of the trained model
+            model.quantize(train_dataset.features)
         # with torch.no_grad():
         # testModel(model)
 
@@ -2,7 +2,7 @@ from abc import ABC, abstractmethod
 
 import pytest
 
-from state_handler.state import StateHandler
+from state import StateHandler
 
 
 @pytest.fixture
@@ -17,9 +17,30 @@ def mock_state_handler():
         def get_legal_actions(self):
             return [0, 1, 2, 3, 4, 5, 6]
 
+        def get_actions_mask(self):
+            return [1, 1, 1, 1, 1, 1, 1]
+
         def step(self, action):
             pass
 
+        def step_back(self):
+            pass
+
+        def zobrist_hash(self):
+            return 0
+
+        def get_board_state(self):
+            return None
+
+        def render(self):
+            pass
+
+        def get_turn(self):
+            return 0
+
+        def get_current_player(self):
+            return 1
+
         def get_state(self):
             return None
 
@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+from neural_network import NeuralNet, transform_2d_to_tensor
+from chess_handler import ChessStateHandler
+
+
+def test_best_move_is_legal_argmax():
+    torch.manual_seed(0)
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    state = transform_2d_to_tensor(game)
+    mask = game.get_actions_mask()
+    policy = model.infer(state)[0][0].cpu().numpy()
+    index = model.get_best_move_index(state, game)
+    assert mask[index] == 1
+    assert index == np.argmax(np.where(mask == 1, policy, -np.inf))
+
+
+def test_sampled_moves_are_legal():
+    torch.manual_seed(0)
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    state = transform_2d_to_tensor(game)
+    mask = game.get_actions_mask()
+    indices = [model.get_best_move_index(state, game, mask, sample=True) for _ in range(50)]
+    assert all(mask[index] == 1 for index in indices)
+    assert len(set(indices)) > 1
+
+
+def test_no_legal_move_in_mask():
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    state = transform_2d_to_tensor(game)
+    mask = np.zeros_like(game.get_actions_mask())
+    assert model.get_best_move_index(state, game, mask) == 0
+    assert model.get_best_move_index(state, game, mask, sample=True) == 0
+
+
+def test_default_policy_returns_legal_move():
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    legal_moves = game.get_legal_actions()
+    assert model.default_policy(game) in legal_moves
+    assert model.default_policy(game, training=True) in legal_moves
@@ -0,0 +1,24 @@
+import torch
+import torch.nn as nn
+from neural_network import NeuralNet, fuse_conv_bn
+
+
+def test_fused_network_gives_same_output():
+    model = NeuralNet(2, 8)
+    # Training steps give the BatchNorm layers running statistics which are not the defaults
+    model.train()
+    with torch.no_grad():
+        for _ in range(3):
+            model(torch.randn(32, 1, 65, 1))
+    model.eval()
+
+    x = torch.randn(4, 1, 65, 1)
+    with torch.inference_mode():
+        policy, value = model(x)
+        fused_model = fuse_conv_bn(model._copy_network())
+        fused_policy, fused_value = fused_model(x)
+    assert not any(isinstance(module, nn.BatchNorm2d) for module in fused_model.modules())
+    assert torch.allclose(policy, fused_policy, atol=1e-5)
+    assert torch.allclose(value, fused_value, atol=1e-5)
+    # The model itself keeps its BatchNorm layers for training
+    assert any(isinstance(module, nn.BatchNorm2d) for module in model.modules())
@@ -0,0 +1,37 @@
+from neural_network import InferenceCache, NeuralNet
+from chess_handler import ChessStateHandler
+
+
+def test_least_recently_used_is_removed():
+    cache = InferenceCache(max_size=2)
+    cache.put(1, 0.5)
+    cache.put(2, -0.5)
+    assert cache.get(1) == 0.5
+    cache.put(3, 0.0)
+    # 2 was used least recently
+    assert cache.get(2) is None
+    assert cache.get(1) == 0.5
+    assert cache.get(3) == 0.0
+    assert len(cache) == 2
+
+
+def play(game: ChessStateHandler, moves: list[str]) -> None:
+    for name in moves:
+        game.step([move for move in game.get_legal_actions() if str(move) == name][0])
+
+
+def test_transpositions_share_cached_value():
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    play(game, ["g1f3", "g8f6"])
+    value = model.predict(game)
+    key = game.zobrist_hash()
+
+    other = ChessStateHandler()
+    play(other, ["g1h3", "g8f6", "h3g1", "b8c6", "g1f3", "c6b8"])
+    # The same position reached by other moves has the same hash
+    assert other.zobrist_hash() == key
+    assert model.get_cached_value(other) == (key, value)
+
+    model.clear_cache()
+    assert model.get_cached_value(other) == (key, None)
@@ -0,0 +1,42 @@
+import pytest
+import torch
+import inference_server
+from inference_server import InferenceServer, InferenceServerError
+from neural_network import NeuralNet, transform_2d_to_tensor
+from chess_handler import ChessStateHandler
+
+
+def test_remote_policy_matches_model():
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    with InferenceServer(model, num_clients=1) as server:
+        initializer, initargs = server.get_worker_initializer()
+        initializer(*initargs)
+        policy = inference_server.worker_policy
+        assert abs(policy.predict(game) - model.predict(game)) < 1e-5
+        assert policy.default_policy(game) == model.default_policy(game)
+        assert len(policy.predict_batch(torch.cat([transform_2d_to_tensor(game)] * 3))) == 3
+
+
+def test_server_uses_quantized_model():
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    model.quantize([transform_2d_to_tensor(game).cpu()] * 4)
+    with InferenceServer(model, num_clients=1) as server:
+        initializer, initargs = server.get_worker_initializer()
+        initializer(*initargs)
+        assert inference_server.worker_policy.predict(game) == model.predict(game)
+
+
+def test_bad_request_raises_in_client():
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    with InferenceServer(model, num_clients=1) as server:
+        initializer, initargs = server.get_worker_initializer()
+        initializer(*initargs)
+        policy = inference_server.worker_policy
+        # Wrong board size, the forward pass fails in the server
+        with pytest.raises(InferenceServerError):
+            policy.infer(torch.zeros(1, 1, 10, 1))
+        # The server keeps running after the error
+        assert abs(policy.predict(game) - model.predict(game)) < 1e-5
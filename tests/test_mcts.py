@@ -1,6 +1,8 @@
 import pytest
 from chess_handler import ChessStateHandler
-from mcts import backpropagation, expansion, selection, simulation, ucb, generate_test_data
+import config
+from mcts import add_virtual_loss, backpropagation, backpropagation_batch, expansion, monte_carlo_tree_search, run_batch, selection, simulation, softmax, ucb, generate_test_data
+from neural_network import NeuralNet
 from node import Node
 from mock_state_handler import mock_state_handler
 
@@ -30,6 +32,21 @@ def test_ucb():
     node.get_parent().set_visits(2)
     assert ucb(node) == pytest.approx(2.44948974278, 0.001)
 
+def test_ucb_virtual_loss():
+    node = Node(state=None, parent=Node(state=None, parent=None))
+    node.set_wins(1)
+    node.set_visits(1)
+    node.get_parent().set_visits(2)
+    node.add_in_flight()
+    node.get_parent().add_in_flight()
+    # The pending evaluation counts as a lost visit
+    assert ucb(node) == pytest.approx(1.04815, 0.001)
+
+
+def test_softmax():
+    assert softmax([1, 2, 3]) == pytest.approx([0.09003, 0.24473, 0.66524], 0.001)
+    # Large visit counts must not overflow
+    assert softmax([-100, 0, 2000]) == pytest.approx([0, 0, 1])
 
 def test_expansion(mock_state_handler):
     node = Node(state=None, parent=None)
@@ -39,15 +56,30 @@ def test_expansion(mock_state_handler):
     assert node.get_children()[0].get_parent() == node
     assert node.get_children()[0].get_state() == None
 
+def test_expansion_stores_children_in_arrays(mock_state_handler):
+    node = Node(state=None, parent=None)
+    child = expansion(node, mock_state_handler)
+    # Every legal move gets an entry, but only the expanded child is created
+    assert len(node.get_children_moves()) == 7
+    assert len(node.get_children_visits()) == 7
+    assert node.get_children() == [child]
+    assert child.get_move() in mock_state_handler.get_legal_actions()
+
 def test_simulation():
     # Set up a simple tree node with a finished game state
     state = mock_state_handler()
     state.is_finished.return_value = True
     state.get_winner.return_value = 1
-    root = Node(state=state, parent=None)
     
     # Ensure that the simulation function returns the correct winner for a finished game state
-    assert simulation(root) == 1
+    assert simulation(state) == 1
+
+def test_simulation_restores_state():
+    state = ChessStateHandler()
+    board_state = state.get_board_state()
+    simulation(state)
+    assert (state.get_board_state() == board_state).all()
+    assert state.get_turn() == 0
 
 def test_backpropagation(mock_state_handler):
     node = Node(state=None, parent=None)
@@ -61,6 +93,49 @@ def test_backpropagation(mock_state_handler):
     assert node.get_visits() == 2
     assert node.get_wins() == 0
 
+def test_backpropagation_to_root():
+    root = Node(state=None, parent=None)
+    child = Node(state=None, parent=root)
+    backpropagation(child, 1)
+    assert child.get_visits() == 1
+    assert child.get_wins() == 1
+    # The parent sees the result from the other player
+    assert root.get_visits() == 1
+    assert root.get_wins() == 0
+
+def test_backpropagation_batch():
+    root = Node(state=None, parent=None)
+    child1 = Node(state=None, parent=root)
+    child2 = Node(state=None, parent=root)
+    for leaf in (child1, child2, child1):
+        add_virtual_loss(leaf)
+    backpropagation_batch([child1, child2, child1], [1, 0, -1])
+    assert child1.get_visits() == 2
+    assert child1.get_wins() == 1
+    assert child2.get_wins() == 0.5
+    assert root.get_visits() == 3
+    assert root.get_wins() == 1.5
+    # The virtual loss is removed again
+    assert root.get_n_in_flight() == 0
+    assert child1.get_n_in_flight() == 0
+
+@pytest.mark.skipif(config.DEVICE.type == "cuda", reason="batches are only deferred on the gpu")
+def test_run_batch_finishes_batch_without_gpu():
+    root = Node(ChessStateHandler())
+    # Nothing overlaps on the cpu, so the batch is backpropagated before run_batch returns
+    assert run_batch(root, NeuralNet(1, 8), 4) is None
+    assert root.get_visits() == 4
+    assert root.get_n_in_flight() == 0
+
+@pytest.mark.skipif(config.DEVICE.type != "cuda", reason="batches are only deferred on the gpu")
+def test_deferred_batches_are_backpropagated():
+    root = Node(ChessStateHandler())
+    monte_carlo_tree_search(root, NeuralNet(1, 8), max_itr=12, batch_size=4)
+    # The last batch is still pending when the loop ends, and must be finished as well
+    assert root.get_visits() == 12
+    assert root.get_n_in_flight() == 0
+    assert all(child.get_n_in_flight() == 0 for child in root.get_children())
+
 def test_mcts(mock_state_handler):
     # create root node
     root = Node(state=None, parent=None)
@@ -0,0 +1,29 @@
+import math
+import numpy as np
+import pytest
+from mcts import ucb
+from mcts_core import best_child_index, ucb_values, _best_child_index_numpy
+from node import Node
+
+
+def test_best_child_index():
+    children_wins = np.array([2, 4, 1, 0], dtype=np.float32)
+    children_visits = np.array([3, 5, 2, 0], dtype=np.int32)
+    children_in_flight = np.array([0, 1, 0, 0], dtype=np.int32)
+    values = ucb_values(children_wins, children_visits, children_in_flight, 10, 1, math.sqrt(2))
+    # The compiled loop and the NumPy version must choose the same child
+    assert best_child_index(children_wins, children_visits, children_in_flight, 10, 1, math.sqrt(2)) == np.argmax(values)
+    assert _best_child_index_numpy(children_wins, children_visits, children_in_flight, 10, 1, math.sqrt(2)) == np.argmax(values)
+
+
+def test_ucb_values_match_ucb():
+    parent_node = Node(state=None, parent=None)
+    parent_node.set_visits(10)
+    children = [Node(state=None, parent=parent_node) for _ in range(3)]
+    for i, child in enumerate(children):
+        child.set_wins(i)
+        child.set_visits(i + 2)
+    children[1].add_in_flight()
+    values = ucb_values(parent_node.get_children_wins(), parent_node.get_children_visits(), parent_node.get_children_in_flight(),
+                        parent_node.get_visits() + parent_node.get_n_in_flight(), 1, math.sqrt(2))
+    assert values == pytest.approx([ucb(child) for child in children], 0.001)
@@ -0,0 +1,43 @@
+from multiprocessing.reduction import ForkingPickler
+import pytest
+import torch
+import torch.multiprocessing
+from neural_network import NeuralNet, transform_2d_to_tensor
+from chess_handler import ChessStateHandler
+
+
+def test_process_state_keeps_quantization():
+    model = NeuralNet(1, 8)
+    game = ChessStateHandler()
+    model.quantize([transform_2d_to_tensor(game).cpu()] * 4)
+    # Sent through a pickle, the same way the self-play workers get it
+    process_state = ForkingPickler.loads(ForkingPickler.dumps(model.get_process_state()))
+    copy = NeuralNet.from_process_state(process_state)
+    assert copy._quantized_model is not None
+    assert copy.predict(game) == model.predict(game)
+
+
+# The engine used on x86 machines and the one used on ARM, e.g. Apple silicon
+@pytest.mark.parametrize("engine", [engine for engine in ("x86", "qnnpack") if engine in torch.backends.quantized.supported_engines])
+def test_quantized_predictions(engine):
+    previous_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    try:
+        model = NeuralNet(1, 8)
+        game = ChessStateHandler()
+        features = []
+        for move in game.get_legal_actions()[:8]:
+            game.step(move)
+            features.append(transform_2d_to_tensor(game).cpu())
+            game.step_back()
+        float_value = model.predict(game)
+        model.quantize(features)
+        assert model._quantized_model is not None
+
+        value = model.predict(game)
+        assert -1 <= value <= 1
+        assert abs(value - float_value) < 0.1
+        assert model.default_policy(game) in game.get_legal_actions()
+        assert model.default_policy(game, training=True) in game.get_legal_actions()
+    finally:
+        torch.backends.quantized.engine = previous_engine